@@ -9,6 +9,8 @@ DAILY_DIR="data/unprocessed/daily"
 HOURLY_DIR="data/unprocessed/24hours"
 TEMP_DIR="data/temp_config"
 FAILED_JOBS_FILE="data/failed_jobs.json"
+FAILED_JOBS_LOG="data/failed_jobs.jsonl"
+SIGNED_ASSET_FILE="data/.signed_asset.json"
 
 # Create directories if they don't exist (so rm doesn't fail)
 mkdir -p "$DAILY_DIR"
@@ -26,7 +28,10 @@ echo "Cleaning temp config files..."
 rm -f "$TEMP_DIR"/*
 
 echo "Cleaning failed jobs log..."
-rm -f "$FAILED_JOBS_FILE"
+rm -f "$FAILED_JOBS_FILE" "$FAILED_JOBS_LOG"
+
+echo "Cleaning cached signed asset..."
+rm -f "$SIGNED_ASSET_FILE"
 
 echo "Data cleaning complete."
 
@@ -1,8 +1,10 @@
 """Configuration file for CONUS404 data download and processing."""
 
 import datetime as dt
+import os
 from typing import Dict
 import numpy as np
+import psutil
 
 # Date range for download
 START_DATE = dt.date(1988, 2, 3)
@@ -26,16 +28,57 @@ DERIVED_VARS = {
     "W": {
         "depends_on": ("U10", "V10"),
         "intensive": True,
-        "calc_fn": lambda u, v: np.sqrt(u**2 + v**2)
+        # Single-pass ufunc: no u**2 / v**2 temporaries
+        "calc_fn": np.hypot
     }
 }
 
+# int16 packing for the daily NetCDF files: value = packed * scale_factor + add_offset.
+# Variables not listed here are written as float32.
+NETCDF_PACKING: Dict[str, dict] = {
+    "T2": {"scale_factor": 0.01, "add_offset": 273.15},    # K, 0.01 K steps over +/-327 K
+    "TD2": {"scale_factor": 0.01, "add_offset": 273.15},   # Same as T2 so rounding keeps TD2 <= T2
+    "Q2": {"scale_factor": 1e-6, "add_offset": 0.0},       # kg/kg, up to 0.0327
+    "PSFC": {"scale_factor": 2.0, "add_offset": 80000.0},  # Pa, 14.5 to 145.5 kPa
+    "LAI": {"scale_factor": 0.001, "add_offset": 0.0},     # m2/m2, up to 32.7
+    "U10": {"scale_factor": 0.01, "add_offset": 0.0},      # m/s, +/-327
+    "V10": {"scale_factor": 0.01, "add_offset": 0.0},      # m/s, +/-327
+    "W": {"scale_factor": 0.01, "add_offset": 0.0},        # m/s, up to 327
+}
+
 # Subprocess settings (replaces CONCURRENT_DAYS)
-MAX_CONCURRENT_PROCESSES = 5  # Number of parallel subprocess workers
+PROCESS_MEMORY_ESTIMATE_GB = 2  # Rough peak memory of one day's download + aggregation
+
+try:
+    USABLE_CPUS = len(os.sched_getaffinity(0))
+except AttributeError:  # Not available on macOS
+    USABLE_CPUS = os.cpu_count() or 1
+
+def _default_max_processes() -> int:
+    """Workers that fit this host: usable CPUs, capped by available memory."""
+    by_memory = int(psutil.virtual_memory().available / (PROCESS_MEMORY_ESTIMATE_GB * 1024**3))
+    return max(1, min(USABLE_CPUS, by_memory))
+
+# Number of parallel workers; set CONUS404_MAX_PROCS to override the auto-sizing
+MAX_CONCURRENT_PROCESSES = int(os.environ.get("CONUS404_MAX_PROCS", 0)) or _default_max_processes()
 
 # Directory paths
 DATA_DIR = "data"
 LOG_DIR = "logs"
+# Per-day NetCDF output; created once at start-up, not per day
+DAILY_DIR = os.path.join(DATA_DIR, "unprocessed", "daily")
+# Static lat/lon grid shared by every daily file (written once, not per day)
+GRID_FILE = os.path.join(DAILY_DIR, "conus404_grid.nc")
+LOG_BUFFER_SIZE = 8192  # bytes buffered before the driver log is written out
+
+# Signed Planetary Computer asset shared with the download subprocesses.
+# SAS tokens last about an hour; the driver re-signs well before that and
+# workers fall back to signing themselves if the cached copy is too old.
+SIGNED_ASSET_FILE = os.path.join(DATA_DIR, ".signed_asset.json")
+SIGNED_ASSET_REFRESH_INTERVAL = 40 * 60  # seconds
+SIGNED_ASSET_MAX_AGE = 45 * 60  # seconds
+# Environment variable the driver uses to hand the signed asset to --isolated children
+SIGNED_ASSET_ENV = "CONUS404_SIGNED_ASSET"
 
 
 
@@ -49,3 +92,4 @@ LOG_DIR = "logs"
 MEMORY_CHECK_INTERVAL = 30  # seconds between memory checks
 MEMORY_WARNING_THRESHOLD = 85  # percent
 MEMORY_CRITICAL_THRESHOLD = 90  # percent
+MEMORY_STATS_TTL = 1.0  # seconds to reuse a psutil.virtual_memory() snapshot
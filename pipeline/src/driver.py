@@ -1,100 +1,174 @@
-"""Driver script to manage concurrent subprocess downloads."""
+"""Driver script to manage concurrent downloads (in-process threads or subprocesses)."""
 
+import argparse
+import asyncio
+import atexit
 import datetime as dt
 import json
 import os
 import subprocess
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Optional
+import dask
+import pandas as pd
 import psutil
 
 from config import (
     START_DATE,
     END_DATE,
     DATA_DIR,
+    DAILY_DIR,
     LOG_DIR,
     MAX_CONCURRENT_PROCESSES,
     MEMORY_CHECK_INTERVAL,
     MEMORY_WARNING_THRESHOLD,
     MEMORY_CRITICAL_THRESHOLD,
+    MEMORY_STATS_TTL,
+    LOG_BUFFER_SIZE,
+    SIGNED_ASSET_ENV,
+    SIGNED_ASSET_FILE,
+    SIGNED_ASSET_REFRESH_INTERVAL,
+    USABLE_CPUS,
     VARIABLE_AGG_MAP
 )
+from single_download import (
+    fetch_signed_asset,
+    get_signed_conus_dataset,
+    plan_aggregation,
+    process_day,
+    write_signed_asset,
+)
+from proc_utils import spawn_day_subprocess, wait_for_process_exit
 
-# This is the single JSON file for the *entire run*
+# This is the single JSON file for the *entire run* (read by retry_failed.py)
 FAILED_JOBS_FILE = os.path.join(DATA_DIR, "failed_jobs.json")
+# Failures are appended here as they happen and compacted into
+# FAILED_JOBS_FILE once at the end of the run
+FAILED_JOBS_LOG = os.path.join(DATA_DIR, "failed_jobs.jsonl")
+# Per-day logs of the --isolated subprocesses
+SUBPROCESS_LOG_DIR = os.path.join(LOG_DIR, "subprocesses")
 
 
 class DownloadDriver:
-    """Manages concurrent subprocess downloads with monitoring."""
+    """Manages concurrent daily downloads with monitoring."""
 
     def __init__(self, start_date: dt.date, end_date: dt.date,
-                 max_processes: int = MAX_CONCURRENT_PROCESSES):
+                 max_processes: int = MAX_CONCURRENT_PROCESSES,
+                 isolated: bool = False):
         self.start_date = start_date
         self.end_date = end_date
         self.max_processes = max_processes
+        # True: one subprocess per day (OOM-safe); False: threads in this process
+        self.isolated = isolated
 
         # Setup logging
         os.makedirs(LOG_DIR, exist_ok=True)
         timestamp = dt.datetime.now().strftime("%Y%m%d_%H%M%S")
         self.log_file = os.path.join(LOG_DIR, f"driver_{timestamp}.log")
+        # Keep one buffered handle open for the whole run; flushed at
+        # checkpoints (process completions, periodic checks, shutdown)
+        self._log_fp = open(self.log_file, "a", buffering=LOG_BUFFER_SIZE)
+        atexit.register(self._log_fp.close)
+        # Line-buffered FAILED_JOBS_LOG handle, opened (truncating) in run()
+        self._fail_fp = None
 
         # Process tracking
-        self.active_processes: Dict[int, tuple] = {}  # pid -> (date, process, start_time)
+        self.active_processes: Dict[int, tuple] = {}  # pid -> (date, process, start_time, ps_process)
         self.completed_dates: List[dt.date] = []
         self.failed_dates: List[dt.date] = []
+
+        # (monotonic timestamp, stats) of the last virtual_memory() snapshot
+        self._mem_cache: tuple = (0.0, None)
+
+        # time.time() of the last successful asset signing
+        self._asset_refreshed_at = 0.0
+        # Environment for --isolated children, carrying the signed asset
+        self._child_env: Optional[dict] = None
         
     def print_and_log(self, message: str):
         """Print message with timestamp and log to file."""
         timestamp = dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         log_line = f"[{timestamp}] {message}"
         print(log_line, flush=True)
+        self._log_fp.write(log_line + "\n")
 
-        with open(self.log_file, "a") as f:
-            f.write(log_line + "\n")
+    def flush_log(self):
+        """Flush buffered driver log lines to disk."""
+        self._log_fp.flush()
 
-    def log_failure(self, date: dt.date, return_code: int):
-        """Logs the failed job to the main JSON file."""
+    def log_failure(self, date: dt.date, error_message: str):
+        """Appends the failed job as one line to the failure JSONL log."""
         try:
-            os.makedirs(DATA_DIR, exist_ok=True)
-            
-            # Read existing failures
-            failures = {}
-            if os.path.exists(FAILED_JOBS_FILE):
-                try:
-                    with open(FAILED_JOBS_FILE, 'r') as f:
-                        failures = json.load(f)
-                except json.JSONDecodeError:
-                    self.print_and_log(f"WARNING: Could not parse {FAILED_JOBS_FILE}, overwriting.")
-                    failures = {}
-
             date_str = date.strftime("%Y-%m-%d")
-            all_vars_list = list(VARIABLE_AGG_MAP.keys())
-
-            # Add or update the failure in the dictionary
-            failures[date_str] = {
+            failure = {
                 "date": date_str,
-                "variables_to_retry": all_vars_list,
-                "error_message": f"Subprocess failed with exit code {return_code}",
+                "variables_to_retry": list(VARIABLE_AGG_MAP.keys()),
+                "error_message": error_message,
                 "last_attempt": dt.datetime.now().isoformat()
             }
 
-            # Write the entire dictionary back
+            if self._fail_fp is None:
+                self._fail_fp = open(FAILED_JOBS_LOG, 'a', buffering=1)
+                atexit.register(self._fail_fp.close)
+            self._fail_fp.write(json.dumps(failure) + "\n")
+
+            self.print_and_log(f"  -> Successfully logged failure to {FAILED_JOBS_LOG}")
+        except Exception as e:
+            self.print_and_log(f"  -> CRITICAL: Failed to log failure for {date}. Error: {e}")
+
+    def compact_failures(self):
+        """Rewrites the JSONL failure log as the date-keyed FAILED_JOBS_FILE once."""
+        failures = {}
+        try:
+            if os.path.exists(FAILED_JOBS_LOG):
+                with open(FAILED_JOBS_LOG, 'r') as f:
+                    for line in f:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            entry = json.loads(line)
+                        except json.JSONDecodeError:
+                            self.print_and_log(f"WARNING: Skipping unparsable line in {FAILED_JOBS_LOG}")
+                            continue
+                        # Later entries for the same date win
+                        failures[entry["date"]] = entry
+
             with open(FAILED_JOBS_FILE, 'w') as f:
                 json.dump(failures, f, indent=4)
+            self.print_and_log(f"Wrote {len(failures)} failure(s) to {FAILED_JOBS_FILE}")
+        except Exception as e:
+            self.print_and_log(f"CRITICAL: Could not compact failure log. Error: {e}")
 
-            self.print_and_log(f"  -> Successfully logged failure to {FAILED_JOBS_FILE}")
+    def refresh_signed_asset(self):
+        """Sign the CONUS404 asset once and share it with the subprocesses."""
+        try:
+            asset = fetch_signed_asset()
+            write_signed_asset(asset)
+            self._child_env = {**os.environ, SIGNED_ASSET_ENV: json.dumps(asset)}
+            self._asset_refreshed_at = time.time()
+            self.print_and_log(f"Refreshed signed asset: {SIGNED_ASSET_FILE}")
         except Exception as e:
-            self.print_and_log(f"  -> CRITICAL: Failed to log failure for {date}. Error: {e}")
+            # Subprocesses sign for themselves if the cached asset is stale
+            self.print_and_log(f"WARNING: Could not refresh signed asset. {e}")
 
     def get_memory_stats(self) -> dict:
-        """Get current system memory statistics."""
+        """Get current system memory statistics (cached for MEMORY_STATS_TTL seconds)."""
+        cached_at, stats = self._mem_cache
+        now = time.monotonic()
+        if stats is not None and now - cached_at < MEMORY_STATS_TTL:
+            return stats
+
         virtual_mem = psutil.virtual_memory()
-        return {
+        stats = {
             "available_mb": virtual_mem.available / (1024 * 1024),
             "total_mb": virtual_mem.total / (1024 * 1024),
             "percent_used": virtual_mem.percent
         }
+        self._mem_cache = (now, stats)
+        return stats
 
     def log_memory_stats(self, context: str = ""):
         stats = self.get_memory_stats()
@@ -115,12 +189,13 @@ class DownloadDriver:
             return
         
         self.print_and_log(f"Active subprocesses: {len(self.active_processes)}")
-        for pid, (date, proc, start_time) in self.active_processes.items():
+        for pid, (date, proc, start_time, ps_proc) in self.active_processes.items():
             duration = time.time() - start_time
             try:
-                p = psutil.Process(pid)
-                mem_mb = p.memory_info().rss / (1024 * 1024)
-                status = p.status()
+                # Read memory and status from a single /proc snapshot
+                with ps_proc.oneshot():
+                    mem_mb = ps_proc.memory_info().rss / (1024 * 1024)
+                    status = ps_proc.status()
                 self.print_and_log(f"  PID {pid}: {date} | Runtime: {duration:.1f}s | "
                                    f"Memory: {mem_mb:.1f}MB | Status: {status}")
             except psutil.NoSuchProcess:
@@ -128,37 +203,16 @@ class DownloadDriver:
 
     def get_dates_to_process(self) -> List[dt.date]:
         """Get list of dates to process."""
-        dates = []
-        current = self.start_date
-        while current <= self.end_date:
-            dates.append(current)
-            current += dt.timedelta(days=1)
-        return dates
+        return list(pd.date_range(self.start_date, self.end_date, freq="D").date)
 
     def launch_subprocess(self, date: dt.date) -> Optional[subprocess.Popen]:
         """Launch a subprocess to download a single day."""
         date_str = date.strftime("%Y-%m-%d")
-
-        cmd = [
-            sys.executable,
-            os.path.join(os.path.dirname(__file__), "single_download.py"),
-            date_str
-        ]
-
-        log_dir = os.path.join(LOG_DIR, "subprocesses")
-        os.makedirs(log_dir, exist_ok=True)
-        log_file = os.path.join(log_dir, f"download_{date.strftime('%Y%m%d')}.log")
+        log_file = os.path.join(SUBPROCESS_LOG_DIR, f"download_{date.strftime('%Y%m%d')}.log")
 
         try:
-            with open(log_file, 'w') as f:
-                proc = subprocess.Popen(
-                    cmd,
-                    stdout=f,
-                    stderr=subprocess.STDOUT,
-                    text=True
-                )
-            
-            self.active_processes[proc.pid] = (date, proc, time.time())
+            proc = spawn_day_subprocess(date, log_file, env=self._child_env)
+            self.active_processes[proc.pid] = (date, proc, time.time(), psutil.Process(proc.pid))
             self.print_and_log(f"Launched subprocess PID {proc.pid} for {date_str} (log: {log_file})")
             
             return proc
@@ -171,7 +225,7 @@ class DownloadDriver:
         """Check for completed processes and update tracking."""
         completed_pids = []
 
-        for pid, (date, proc, start_time) in list(self.active_processes.items()):
+        for pid, (date, proc, start_time, _) in list(self.active_processes.items()):
             return_code = proc.poll()
 
             if return_code is not None:
@@ -186,12 +240,156 @@ class DownloadDriver:
                     self.print_and_log(f"FAILED: PID {pid} failed for {date} (exit code {return_code}) "
                                        f"after {duration:.1f}s")
                     # Log the failure
-                    self.log_failure(date, return_code)
+                    self.log_failure(date, f"Subprocess failed with exit code {return_code}")
 
         # Remove completed processes
         for pid in completed_pids:
             del self.active_processes[pid]
 
+        if completed_pids:
+            self.flush_log()
+
+    def log_progress(self, total_dates: int, active: int, start_time: float):
+        """Log completed/failed/active/pending counts."""
+        completed = len(self.completed_dates)
+        failed = len(self.failed_dates)
+        remaining = total_dates - completed - failed - active
+        elapsed = time.time() - start_time
+
+        self.print_and_log(f"Progress: {completed} completed, {failed} failed, "
+                           f"{active} active, {remaining} pending | "
+                           f"Elapsed: {elapsed:.1f}s")
+
+    def run_subprocesses(self, dates_to_process: List[dt.date], start_time: float):
+        """Run each date in its own single_download.py subprocess (--isolated)."""
+        os.makedirs(SUBPROCESS_LOG_DIR, exist_ok=True)
+        total_dates = len(dates_to_process)
+        date_index = 0
+        last_memory_check = time.time()
+
+        while date_index < total_dates or self.active_processes:
+            self.check_completed_processes()
+
+            while (len(self.active_processes) < self.max_processes and 
+                   date_index < total_dates):
+                
+                date = dates_to_process[date_index]
+                date_index += 1
+                
+                self.print_and_log(f"Launching download {date_index}/{total_dates}: {date}")
+                self.launch_subprocess(date)
+
+            current_time = time.time()
+            if current_time - last_memory_check >= MEMORY_CHECK_INTERVAL:
+                self.log_memory_stats("Periodic check")
+                self.log_process_stats()
+                self.log_progress(total_dates, len(self.active_processes), start_time)
+                
+                if current_time - self._asset_refreshed_at >= SIGNED_ASSET_REFRESH_INTERVAL:
+                    self.refresh_signed_asset()
+
+                self.flush_log()
+                last_memory_check = current_time
+
+            if self.active_processes:
+                time_to_next_check = MEMORY_CHECK_INTERVAL - (time.time() - last_memory_check)
+                wait_for_process_exit(self.active_processes, time_to_next_check)
+
+    async def run_in_process(self, dates_to_process: List[dt.date], start_time: float):
+        """Run all dates on a thread pool in this process against one shared dataset.
+
+        Avoids a Python start-up and a Zarr store open per day. The dataset is
+        re-opened whenever the signed asset is refreshed; days already running
+        keep the handle they started with, and a replaced handle is closed
+        once the last of those days finishes.
+        """
+        loop = asyncio.get_running_loop()
+        total_dates = len(dates_to_process)
+        active = 0
+
+        ds = await loop.run_in_executor(None, get_signed_conus_dataset)
+        if ds is None:
+            self.print_and_log("FATAL: Could not open CONUS404 dataset; failing all dates.")
+            for date in dates_to_process:
+                self.failed_dates.append(date)
+                self.log_failure(date, "Could not open CONUS404 dataset")
+            return
+        # Variable partition depends only on the store schema; work it out once
+        plan = plan_aggregation(ds)
+
+        # id(dataset) -> number of running days using it
+        users: Dict[int, int] = {}
+
+        def release(day_ds):
+            users[id(day_ds)] -= 1
+            if day_ds is not ds and users[id(day_ds)] == 0:
+                del users[id(day_ds)]
+                day_ds.close()
+
+        # Shared by the workers; each pulls the next date only when it is free,
+        # so nothing is queued ahead of the max_processes days in flight
+        pending = enumerate(dates_to_process, start=1)
+
+        async def worker(executor: ThreadPoolExecutor):
+            nonlocal active
+            for index, date in pending:
+                active += 1
+                self.print_and_log(f"Launching download {index}/{total_dates}: {date}")
+                day_start = time.time()
+                day_ds = ds
+                users[id(day_ds)] = users.get(id(day_ds), 0) + 1
+                try:
+                    success = await loop.run_in_executor(executor, process_day, date, day_ds, plan)
+                finally:
+                    release(day_ds)
+                active -= 1
+
+                duration = time.time() - day_start
+                if success:
+                    self.completed_dates.append(date)
+                    self.print_and_log(f"SUCCESS: completed {date} in {duration:.1f}s")
+                else:
+                    self.failed_dates.append(date)
+                    self.print_and_log(f"FAILED: {date} after {duration:.1f}s")
+                    self.log_failure(date, "In-process download failed")
+                self.flush_log()
+
+        async def monitor():
+            nonlocal ds, plan
+            while True:
+                await asyncio.sleep(MEMORY_CHECK_INTERVAL)
+                self.log_memory_stats("Periodic check")
+                self.log_progress(total_dates, active, start_time)
+
+                if time.time() - self._asset_refreshed_at >= SIGNED_ASSET_REFRESH_INTERVAL:
+                    await loop.run_in_executor(None, self.refresh_signed_asset)
+                    new_ds = await loop.run_in_executor(None, get_signed_conus_dataset)
+                    if new_ds is not None:
+                        old_ds = ds
+                        ds, plan = new_ds, plan_aggregation(new_ds)
+                        # Days still running on the old handle close it in release()
+                        if users.get(id(old_ds), 0) == 0:
+                            users.pop(id(old_ds), None)
+                            old_ds.close()
+
+                self.flush_log()
+
+        # Every day's load()/compute() would otherwise start its own dask pool
+        # of ~cpus threads; split the CPUs between the concurrent days so
+        # thread count and chunks in flight (PROCESS_MEMORY_ESTIMATE_GB per
+        # day) stay bounded
+        dask_workers = max(1, USABLE_CPUS // self.max_processes)
+        self.print_and_log(f"Dask threads per day: {dask_workers}")
+
+        monitor_task = asyncio.create_task(monitor())
+        try:
+            with dask.config.set(num_workers=dask_workers), \
+                    ThreadPoolExecutor(max_workers=self.max_processes) as executor:
+                await asyncio.gather(*(worker(executor) for _ in range(self.max_processes)))
+        finally:
+            monitor_task.cancel()
+            ds.close()
+
     def run(self):
         """Main driver loop."""
         self.print_and_log("=" * 80)
@@ -201,19 +399,25 @@ class DownloadDriver:
         # --- NEW: Clear old failure log ---
         try:
             os.makedirs(DATA_DIR, exist_ok=True)
-            # Clear the file by writing an empty JSON object
+            os.makedirs(DAILY_DIR, exist_ok=True)
+            # Clear the summary by writing an empty JSON object
             with open(FAILED_JOBS_FILE, 'w') as f:
                 json.dump({}, f)
-            self.print_and_log(f"Cleared old failure log: {FAILED_JOBS_FILE}")
+            # Truncate the append-only log and keep it open for log_failure
+            self._fail_fp = open(FAILED_JOBS_LOG, 'w', buffering=1)
+            atexit.register(self._fail_fp.close)
+            self.print_and_log(f"Cleared old failure logs: {FAILED_JOBS_FILE}, {FAILED_JOBS_LOG}")
         except Exception as e:
             self.print_and_log(f"WARNING: Could not clear failure log. {e}")
         # --- END NEW BLOCK ---
 
         self.print_and_log(f"Date range: {self.start_date} to {self.end_date}")
         self.print_and_log(f"Max concurrent processes: {self.max_processes}")
+        self.print_and_log(f"Mode: {'isolated subprocesses' if self.isolated else 'in-process threads'}")
         self.print_and_log(f"Log file: {self.log_file}")
 
         self.log_memory_stats("Initial")
+        self.refresh_signed_asset()
         
         dates_to_process = self.get_dates_to_process()
         total_dates = len(dates_to_process)
@@ -223,40 +427,11 @@ class DownloadDriver:
         self.print_and_log("Starting download processes")
         self.print_and_log("=" * 80)
         
-        date_index = 0
-        last_memory_check = time.time()
         start_time = time.time()
-
-        while date_index < total_dates or self.active_processes:
-            self.check_completed_processes()
-
-            while (len(self.active_processes) < self.max_processes and 
-                   date_index < total_dates):
-                
-                date = dates_to_process[date_index]
-                date_index += 1
-                
-                self.print_and_log(f"Launching download {date_index}/{total_dates}: {date}")
-                self.launch_subprocess(date)
-                self.log_process_stats()
-
-            current_time = time.time()
-            if current_time - last_memory_check >= MEMORY_CHECK_INTERVAL:
-                self.log_memory_stats("Periodic check")
-                self.log_process_stats()
-
-                completed = len(self.completed_dates)
-                failed = len(self.failed_dates)
-                remaining = total_dates - completed - failed - len(self.active_processes)
-                elapsed = current_time - start_time
-
-                self.print_and_log(f"Progress: {completed} completed, {failed} failed, "
-                                   f"{len(self.active_processes)} active, {remaining} pending | "
-                                   f"Elapsed: {elapsed:.1f}s")
-                
-                last_memory_check = current_time
-
-            time.sleep(1)
+        if self.isolated:
+            self.run_subprocesses(dates_to_process, start_time)
+        else:
+            asyncio.run(self.run_in_process(dates_to_process, start_time))
 
         self.print_and_log("=" * 80)
         self.print_and_log("Download Processing Complete")
@@ -269,49 +444,74 @@ class DownloadDriver:
 
         if self.failed_dates:
             self.print_and_log(f"Failed dates: {[str(d) for d in self.failed_dates]}")
+            self.compact_failures()
 
             # --- AUTOMATIC RETRY BLOCK ---
             self.print_and_log("=" * 80)
             self.print_and_log("STARTING AUTOMATIC RETRY PROCESS")
             self.print_and_log("=" * 80)
 
-            # Path is now src/retry_failed.py
-            retry_cmd = [sys.executable, os.path.join("src", "retry_failed.py")]
-            retry_log_file = os.path.join(LOG_DIR, f"retry_driver_{dt.datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
-            self.print_and_log(f"Launching retry script. Log will be in: {retry_log_file}")
-
             try:
-                with open(retry_log_file, 'w') as f:
-                    result = subprocess.run(
-                        retry_cmd,
-                        stdout=f,
-                        stderr=subprocess.STDOUT,
-                        text=True,
-                        check=False 
-                    )
-                self.print_and_log(f"Retry script finished with exit code {result.returncode}.")
-                self.print_and_log(f"Please check {retry_log_file} for details.")
-
-            except FileNotFoundError:
-                 self.print_and_log(f"FATAL: Could not find 'src/retry_failed.py'. Skipping automatic retry.")
-            except Exception as e:
-                self.print_and_log(f"FATAL: Failed to launch retry_failed.py: {e}")
+                from retry_failed import main as retry_main
+            except ImportError as e:
+                retry_main = None
+                self.print_and_log(f"WARNING: Could not import retry_failed ({e}). Falling back to a subprocess.")
+
+            if retry_main is not None:
+                # Same interpreter: no second start-up or re-import of xarray/config
+                self.print_and_log("Running retry in-process. Its log is logs/retry_driver_<timestamp>.log")
+                self.flush_log()
+                try:
+                    exit_code = retry_main()
+                    self.print_and_log(f"Retry finished with exit code {exit_code}.")
+                except Exception as e:
+                    self.print_and_log(f"FATAL: Retry failed with an unhandled exception: {e}")
+            else:
+                # Path is now src/retry_failed.py
+                retry_cmd = [sys.executable, os.path.join("src", "retry_failed.py")]
+                retry_log_file = os.path.join(LOG_DIR, f"retry_driver_{dt.datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
+                self.print_and_log(f"Launching retry script. Log will be in: {retry_log_file}")
+                self.flush_log()
+
+                try:
+                    with open(retry_log_file, 'w') as f:
+                        result = subprocess.run(
+                            retry_cmd,
+                            stdout=f,
+                            stderr=subprocess.STDOUT,
+                            text=True,
+                            check=False 
+                        )
+                    self.print_and_log(f"Retry script finished with exit code {result.returncode}.")
+                    self.print_and_log(f"Please check {retry_log_file} for details.")
+
+                except FileNotFoundError:
+                     self.print_and_log(f"FATAL: Could not find 'src/retry_failed.py'. Skipping automatic retry.")
+                except Exception as e:
+                    self.print_and_log(f"FATAL: Failed to launch retry_failed.py: {e}")
             # --- END RETRY BLOCK ---
         else:
             self.print_and_log("No failures to retry.")
 
         self.log_memory_stats("Final")
-        
+        self.flush_log()
+
         return len(self.failed_dates) == 0
 
 
 if __name__ == "__main__":
     print(f"Starting CONUS404 download driver at {dt.datetime.now()}", flush=True)
 
+    parser = argparse.ArgumentParser(description="CONUS404 download driver")
+    parser.add_argument("--isolated", action="store_true",
+                        help="run each day in its own subprocess (slower, but an OOM only kills that day)")
+    args = parser.parse_args()
+
     driver = DownloadDriver(
         start_date=START_DATE,
         end_date=END_DATE,
-        max_processes=MAX_CONCURRENT_PROCESSES
+        max_processes=MAX_CONCURRENT_PROCESSES,
+        isolated=args.isolated
     )
 
     success = driver.run()
@@ -0,0 +1,70 @@
+"""
+Subprocess helpers shared by driver.py (--isolated) and retry_failed.py.
+"""
+
+import datetime as dt
+import os
+import select
+import subprocess
+import sys
+import time
+from typing import Optional
+
+
+def wait_for_process_exit(pids, timeout: float):
+    """Block until any of pids exits or the timeout elapses.
+
+    Polls a pidfd per child, so callers wake as soon as a download finishes.
+    The children are not reaped here; Popen.poll() still collects them and
+    their exit codes. Falls back to a short sleep where pidfds are missing
+    (non-Linux, or kernels older than 5.3).
+    """
+    timeout = max(0.0, timeout)
+    if not hasattr(os, "pidfd_open"):
+        time.sleep(min(1.0, timeout))
+        return
+
+    poller = select.poll()
+    pidfds = []
+    try:
+        for pid in pids:
+            try:
+                fd = os.pidfd_open(pid)
+            except ProcessLookupError:
+                # Already gone; no need to wait at all
+                return
+            except OSError:
+                # e.g. ENOSYS: the syscall exists in Python but not the kernel
+                time.sleep(min(1.0, timeout))
+                return
+            pidfds.append(fd)
+            poller.register(fd, select.POLLIN)
+        poller.poll(timeout * 1000)
+    finally:
+        for fd in pidfds:
+            os.close(fd)
+
+def spawn_day_subprocess(date: dt.date, log_file: str,
+                         env: Optional[dict] = None) -> subprocess.Popen:
+    """Start single_download.py for one day, writing its output to log_file."""
+    cmd = [
+        sys.executable,
+        os.path.join(os.path.dirname(__file__), "single_download.py"),
+        date.strftime("%Y-%m-%d")
+    ]
+
+    # Hand the child a raw fd so its output goes straight to disk;
+    # the parent's copy is closed as soon as the child has it
+    fd = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+    try:
+        return subprocess.Popen(
+            cmd,
+            stdout=fd,
+            stderr=subprocess.STDOUT,
+            # Our fds are all non-inheritable (PEP 446), so skip the
+            # close-everything pass and let CPython use posix_spawn
+            close_fds=False,
+            env=env
+        )
+    finally:
+        os.close(fd)
@@ -1,6 +1,7 @@
 """
 Script to retry failed downloads concurrently.
-Reads from 'data/failed_jobs.json'.
+Reads from 'data/failed_jobs.json' (plus 'data/failed_jobs.jsonl' if the
+driver died before compacting it).
 Writes "ultimate" failures to 'ultimate_failures.json' in the root.
 """
 
@@ -11,35 +12,39 @@ import datetime as dt
 import time
 import sys
 import subprocess
-from typing import List, Dict, Tuple, Optional
+from typing import List, Dict, Tuple, Optional, TextIO
 import psutil
 
 # Import config from the main project
 from config import (
     LOG_DIR,
     DATA_DIR,
+    LOG_BUFFER_SIZE,
     VARIABLE_AGG_MAP
 )
+from proc_utils import spawn_day_subprocess, wait_for_process_exit
 
 # --- Hard-code 2 concurrent processes for retry ---
 MAX_RETRY_PROCESSES = 2
 # Input file from driver.py
 FAILED_JOBS_FILE = os.path.join(DATA_DIR, "failed_jobs.json")
+# Append-only log the driver compacts into FAILED_JOBS_FILE at the end of a run
+FAILED_JOBS_LOG = os.path.join(DATA_DIR, "failed_jobs.jsonl")
 # New output file for "ultimate" failures in the *project root*
 # Assumes this script is run from the project root (which run_pipeline.sh does)
 ULTIMATE_FAILURE_FILE = "ultimate_failures.json" 
 
 MEMORY_CHECK_INTERVAL = 30 # seconds
+# Per-day logs of the retry subprocesses
+RETRY_LOG_DIR = os.path.join(LOG_DIR, "subprocesses_retry")
 
 
-def print_and_log(message: str, log_file: str):
-    """Print message with timestamp and log to file."""
+def print_and_log(message: str, log_fp: TextIO):
+    """Print message with timestamp and write it to the open log handle."""
     timestamp = dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     log_line = f"[{timestamp}] {message}"
     print(log_line, flush=True)
-    
-    with open(log_file, "a") as f:
-        f.write(log_line + "\n")
+    log_fp.write(log_line + "\n")
 
 def get_memory_stats() -> dict:
     """Get current system memory statistics."""
@@ -65,43 +70,55 @@ def log_process_stats(log_fn, active_processes):
         return
     
     log_fn(f"Active retry subprocesses: {len(active_processes)}")
-    for pid, (date, proc, start_time) in active_processes.items():
+    for pid, (date, proc, start_time, ps_proc) in active_processes.items():
         duration = time.time() - start_time
         try:
-            p = psutil.Process(pid)
-            mem_mb = p.memory_info().rss / (1024 * 1024)
-            status = p.status()
+            with ps_proc.oneshot():
+                mem_mb = ps_proc.memory_info().rss / (1024 * 1024)
+                status = ps_proc.status()
             log_fn(f"  PID {pid}: {date} | Runtime: {duration:.1f}s | "
                    f"Memory: {mem_mb:.1f}MB | Status: {status}")
         except psutil.NoSuchProcess:
             log_fn(f"  PID {pid}: {date} | Runtime: {duration:.1f}s | Process ended")
 
+def merge_failure_log(failed_jobs: dict, log_fn) -> dict:
+    """Add FAILED_JOBS_LOG entries newer than FAILED_JOBS_FILE to failed_jobs.
+
+    The driver only compacts its JSONL log at the end of a normal run; if it
+    was killed (e.g. an OOM in in-process mode) the JSON is still the empty
+    one written at start-up and the failures are only in the log.
+    """
+    if not os.path.exists(FAILED_JOBS_LOG):
+        return failed_jobs
+    if (os.path.exists(FAILED_JOBS_FILE)
+            and os.path.getmtime(FAILED_JOBS_FILE) >= os.path.getmtime(FAILED_JOBS_LOG)):
+        return failed_jobs
+
+    merged = dict(failed_jobs)
+    with open(FAILED_JOBS_LOG, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # A killed driver can leave a partial last line
+                log_fn(f"WARNING: Skipping unparsable line in {FAILED_JOBS_LOG}")
+                continue
+            merged[entry["date"]] = entry
+    if len(merged) > len(failed_jobs):
+        log_fn(f"{FAILED_JOBS_LOG} is newer than {FAILED_JOBS_FILE} (driver did not finish?); "
+               f"merged {len(merged) - len(failed_jobs)} extra failure(s) from it")
+    return merged
+
 def launch_retry_subprocess(log_fn, date: dt.date) -> Optional[subprocess.Popen]:
     """Launch a subprocess to re-download a single day."""
     date_str = date.strftime("%Y-%m-%d")
-    
-    # Get the directory this script is in (src/)
-    script_dir = os.path.dirname(__file__)
-    
-    cmd = [
-        sys.executable,
-        os.path.join(script_dir, "single_download.py"),
-        date_str
-    ]
-    
-    log_dir = os.path.join(LOG_DIR, "subprocesses_retry")
-    os.makedirs(log_dir, exist_ok=True)
-    sub_log_file = os.path.join(log_dir, f"download_{date.strftime('%Y%m%d')}.log")
+    sub_log_file = os.path.join(RETRY_LOG_DIR, f"download_{date.strftime('%Y%m%d')}.log")
     
     try:
-        with open(sub_log_file, 'w') as f:
-            proc = subprocess.Popen(
-                cmd,
-                stdout=f,
-                stderr=subprocess.STDOUT,
-                text=True
-            )
-        
+        proc = spawn_day_subprocess(date, sub_log_file)
         log_fn(f"Launched RETRY subprocess PID {proc.pid} for {date_str} (log: {sub_log_file})")
         return proc
         
@@ -114,11 +131,18 @@ def main():
     
     # Setup logging for this script
     retry_log_file = os.path.join(LOG_DIR, f"retry_driver_{dt.datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
-    if not os.path.exists(LOG_DIR):
-        os.makedirs(LOG_DIR)
-    
+    os.makedirs(RETRY_LOG_DIR, exist_ok=True)
+
+    # One buffered handle for the whole retry; flushed at checkpoints and
+    # closed on return (main may run inside the driver's process)
+    with open(retry_log_file, "a", buffering=LOG_BUFFER_SIZE) as log_fp:
+        return run_retries(log_fp)
+
+def run_retries(log_fp: TextIO) -> int:
+    """Retry every date in FAILED_JOBS_FILE; returns the exit code."""
+
     def log(message):
-        print_and_log(message, retry_log_file)
+        print_and_log(message, log_fp)
     
     log("=" * 80)
     log("Starting Concurrent Failed Job Retry Script")
@@ -127,17 +151,20 @@ def main():
     log(f"Will write ultimate failures to: {ULTIMATE_FAILURE_FILE}")
     log("=" * 80)
     
-    if not os.path.exists(FAILED_JOBS_FILE):
+    if not os.path.exists(FAILED_JOBS_FILE) and not os.path.exists(FAILED_JOBS_LOG):
         log(f"No failure log file found ({FAILED_JOBS_FILE}). Exiting.")
         with open(ULTIMATE_FAILURE_FILE, 'w') as f:
             json.dump({}, f, indent=4) # Write empty file
         return 0
 
     try:
-        with open(FAILED_JOBS_FILE, 'r') as f:
-            failed_jobs = json.load(f)
+        failed_jobs = {}
+        if os.path.exists(FAILED_JOBS_FILE):
+            with open(FAILED_JOBS_FILE, 'r') as f:
+                failed_jobs = json.load(f)
+        failed_jobs = merge_failure_log(failed_jobs, log)
     except Exception as e:
-        log(f"ERROR: Could not read {FAILED_JOBS_FILE}. Error: {e}")
+        log(f"ERROR: Could not read {FAILED_JOBS_FILE} / {FAILED_JOBS_LOG}. Error: {e}")
         return 1
 
     if not failed_jobs:
@@ -159,7 +186,8 @@ def main():
     total_dates = len(dates_to_process)
     log(f"Loaded {total_dates} unique dates to retry.")
     
-    active_processes: Dict[int, Tuple[dt.date, subprocess.Popen, float]] = {}
+    # pid -> (date, process, start_time, ps_process)
+    active_processes: Dict[int, Tuple[dt.date, subprocess.Popen, float, psutil.Process]] = {}
     completed_dates: List[dt.date] = []
     failed_dates: List[dt.date] = []
     date_index = 0
@@ -171,7 +199,7 @@ def main():
     while date_index < total_dates or active_processes:
         # Check for completed processes
         completed_pids = []
-        for pid, (date, proc, start_time) in list(active_processes.items()):
+        for pid, (date, proc, start_time, _) in list(active_processes.items()):
             return_code = proc.poll()
             if return_code is not None:
                 duration = time.time() - start_time
@@ -195,6 +223,9 @@ def main():
         # Remove completed processes
         for pid in completed_pids:
             del active_processes[pid]
+
+        if completed_pids:
+            log_fp.flush()
             
         # Launch new processes if we have capacity
         while (len(active_processes) < MAX_RETRY_PROCESSES and 
@@ -206,16 +237,20 @@ def main():
             log(f"Launching retry {date_index}/{total_dates}: {date}")
             proc = launch_retry_subprocess(log, date)
             if proc:
-                active_processes[proc.pid] = (date, proc, time.time())
+                active_processes[proc.pid] = (date, proc, time.time(), psutil.Process(proc.pid))
         
         # Periodic memory monitoring
         current_time = time.time()
         if current_time - last_memory_check >= MEMORY_CHECK_INTERVAL:
             log_memory_stats(log, "Periodic check")
             log_process_stats(log, active_processes)
+            log_fp.flush()
             last_memory_check = current_time
 
-        time.sleep(1) # Avoid busy waiting
+        # Sleep until a retry finishes or the next memory check is due
+        if active_processes:
+            wait_for_process_exit(active_processes,
+                                  MEMORY_CHECK_INTERVAL - (time.time() - last_memory_check))
 
     log("=" * 80)
     log("Retry Script Finished")
@@ -1,15 +1,24 @@
 """
 Single day download, aggregation, and validation process for CONUS404 data.
 
-This script is self-contained. It fetches its own fresh STAC token,
+This script is self-contained. It reuses the signed asset cached by the
+driver (or fetches its own fresh STAC token if that is missing or stale),
 downloads and aggregates data for one day, validates the data,
 and then exits with 0 (success) or 1 (failure).
+
+The driver also imports process_day to run days in-process against a
+single shared dataset (see driver.py --isolated for the subprocess mode).
 """
 
+import contextlib
 import datetime as dt
+import json
 import os
 import sys
+import tempfile
+import time
 import xarray as xr
+import dask
 import numpy as np
 import pandas as pd
 import fsspec
@@ -20,159 +29,425 @@ import planetary_computer
 from config import (
     VARIABLE_AGG_MAP,
     DERIVED_VARS,
-    DATA_DIR,
+    NETCDF_PACKING,
+    DAILY_DIR,
+    GRID_FILE,
+    SIGNED_ASSET_ENV,
+    SIGNED_ASSET_FILE,
+    SIGNED_ASSET_MAX_AGE,
 )
 
 def print_with_timestamp(message: str):
     timestamp = dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print(f"[{timestamp}] {message}", flush=True)
 
+def get_required_variables() -> list:
+    """Variables read from the store: aggregated vars plus derived-var inputs."""
+    wanted = list(VARIABLE_AGG_MAP)
+    for info in DERIVED_VARS.values():
+        wanted.extend(dep for dep in info["depends_on"] if dep not in wanted)
+    return wanted
+
+def fetch_signed_asset() -> dict:
+    """Sign the CONUS404 Zarr asset and return everything needed to open it."""
+    catalog = pystac_client.Client.open(
+        "https://planetarycomputer.microsoft.com/api/stac/v1",
+        modifier=planetary_computer.sign_inplace, # This gets a fresh token
+    )
+
+    collection = catalog.get_collection("conus404")
+    asset = collection.assets["zarr-abfs"]
+
+    return {
+        "href": asset.href,
+        "storage_options": asset.extra_fields["xarray:storage_options"],
+        "open_kwargs": asset.extra_fields["xarray:open_kwargs"],
+        "last_refresh": time.time(),
+    }
+
+def write_signed_asset(asset: dict):
+    """Atomically write a signed asset bundle to SIGNED_ASSET_FILE."""
+    os.makedirs(os.path.dirname(SIGNED_ASSET_FILE), exist_ok=True)
+    tmp_file = f"{SIGNED_ASSET_FILE}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(asset, f)
+    os.replace(tmp_file, SIGNED_ASSET_FILE)
+
+def load_signed_asset() -> dict | None:
+    """Return the signed asset bundle passed down by the driver (environment
+    first, then SIGNED_ASSET_FILE), or None if missing or stale."""
+    try:
+        blob = os.environ.get(SIGNED_ASSET_ENV)
+        if blob is not None:
+            asset = json.loads(blob)
+        else:
+            with open(SIGNED_ASSET_FILE, 'r') as f:
+                asset = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+    if time.time() - asset.get("last_refresh", 0) > SIGNED_ASSET_MAX_AGE:
+        return None
+    return asset
+
+def day_aligned_time_chunk(var: xr.DataArray) -> int | None:
+    """Dask time chunk for var: the smallest whole multiple of its Zarr time
+    chunk that covers a day (24 h), or None if the Zarr chunk already does."""
+    if "time" not in var.dims or not var.encoding.get("chunks"):
+        return None
+    zarr_chunk = var.encoding["chunks"][var.dims.index("time")]
+    if zarr_chunk >= 24:
+        return None
+    return zarr_chunk * -(-24 // zarr_chunk)
+
 def get_signed_conus_dataset():
-    print_with_timestamp("Fetching fresh STAC token from Planetary Computer...")
     try:
-        catalog = pystac_client.Client.open(
-            "https://planetarycomputer.microsoft.com/api/stac/v1",
-            modifier=planetary_computer.sign_inplace, # This gets a fresh token
-        )
-        
-        collection = catalog.get_collection("conus404")
-        asset = collection.assets["zarr-abfs"]
-        
-        storage_options = asset.extra_fields["xarray:storage_options"]
-        open_kwargs = asset.extra_fields["xarray:open_kwargs"]
-        asset_href = asset.href
+        asset = load_signed_asset()
+        if asset is not None:
+            print_with_timestamp("Using signed asset from the driver")
+        else:
+            print_with_timestamp("Fetching fresh STAC token from Planetary Computer...")
+            asset = fetch_signed_asset()
         
         print_with_timestamp("Opening Zarr dataset...")
-        mapper = fsspec.get_mapper(asset_href, **storage_options)
+        mapper = fsspec.get_mapper(asset["href"], **asset["storage_options"])
+        # Read consolidated metadata once and defer CF decoding until the
+        # store has been cut down to the variables we actually use
+        open_kwargs = {**asset["open_kwargs"], "consolidated": True, "decode_cf": False,
+                       "chunks": {}}
         ds = xr.open_zarr(mapper, **open_kwargs)
+        keep = [v for v in get_required_variables() if v in ds]
+        # decode_cf=False also skips decode_coords, so lat/lon named in the
+        # "coordinates" attribute are still data variables; keep them for
+        # decode_cf to promote back to coordinates
+        aux_coords = {c for v in keep for c in ds[v].attrs.get("coordinates", "").split()}
+        ds = ds[keep + sorted(c for c in aux_coords if c in ds.data_vars and c not in keep)]
+        # Dask chunks start as the store's own Zarr chunks. Merge sub-day
+        # chunks along time, per variable, so a day is a few whole Zarr
+        # chunks; variables chunked at a day or more are left as stored
+        rechunked = {name: var.chunk({"time": time_chunk})
+                     for name, var in ds.data_vars.items()
+                     if (time_chunk := day_aligned_time_chunk(var)) is not None}
+        ds = ds.assign(rechunked)
+
+        print_with_timestamp("Manually decoding CF conventions (fill values)...")
+        ds = xr.decode_cf(ds)
         return ds
     except Exception as e:
         print_with_timestamp(f"  ERROR: Failed to open dataset. Exception: {e}")
         return None
 
+def build_daily_encoding(ds: xr.Dataset) -> dict:
+    """NetCDF encoding for a daily file: shuffle+zlib everywhere, int16 packing per NETCDF_PACKING."""
+    encoding = {}
+    for var in ds.data_vars:
+        # Byte shuffle groups the slowly varying high bytes of neighbouring
+        # values, which zlib then compresses far better at the same level
+        encoding[var] = {"zlib": True, "complevel": 1, "shuffle": True}
+        if ds[var].dims[:1] == ("time",) and ds[var].ndim >= 3:
+            # One 2-D field per HDF5 chunk instead of h5py's small auto-chunks;
+            # levels of 3-D fields (e.g. Z) get their own chunk
+            encoding[var]["chunksizes"] = (1,) * (ds[var].ndim - 2) + ds[var].shape[-2:]
+        if var in NETCDF_PACKING:
+            encoding[var].update(dtype="int16", _FillValue=-32768, **NETCDF_PACKING[var])
+        else:
+            encoding[var]["dtype"] = "float32"
+    return encoding
+
+def existing_file_problems(daily_file: str, expected: set) -> list:
+    """Reasons an existing daily file can't be reused as-is (empty if it can).
+
+    Checks the layout this version writes, which QC alone does not: every
+    expected variable present, NETCDF_PACKING variables stored as int16 with
+    the configured scale/offset, and no per-file lat/lon (those live in
+    GRID_FILE). Files from older versions fail this and are rebuilt.
+    """
+    try:
+        with xr.open_dataset(daily_file, engine="h5netcdf") as existing:
+            problems = []
+            missing = expected - set(existing.data_vars)
+            if missing:
+                problems.append(f"lacks {sorted(missing)}")
+
+            for var, packing in NETCDF_PACKING.items():
+                if var not in existing:
+                    continue
+                enc = existing[var].encoding
+                if (np.dtype(enc.get("dtype", existing[var].dtype)) != np.int16
+                        or not np.isclose(enc.get("scale_factor", np.nan), packing["scale_factor"])
+                        or not np.isclose(enc.get("add_offset", 0.0), packing["add_offset"])):
+                    problems.append(f"stores {var} without the configured int16 packing")
+
+            aux_coords = [c for c in existing.coords if c not in existing.dims]
+            if aux_coords:
+                problems.append(f"carries its own {sorted(aux_coords)}")
+            return problems
+    except Exception as e:
+        return [f"could not be read ({e})"]
+
+def find_unpackable(ds: xr.Dataset) -> list:
+    """Packed variables with values outside their int16 range, as messages.
+
+    numpy casts such values to int16 with only a warning, wrapping them to
+    plausible numbers that would then pass QC, so they must be caught here.
+    """
+    problems = []
+    for var, packing in NETCDF_PACKING.items():
+        if var not in ds:
+            continue
+        # -32768 is the _FillValue; NaN is written as fill and is fine
+        lo = packing["add_offset"] + packing["scale_factor"] * -32767
+        hi = packing["add_offset"] + packing["scale_factor"] * 32767
+        values = ds[var].values
+        bad = ~np.isnan(values) & ((values < lo) | (values > hi))
+        if bad.any():
+            problems.append(f"{var} has {int(bad.sum())} value(s) outside the packable range "
+                            f"[{lo:g}, {hi:g}] (e.g. {values[bad].flat[0]:g})")
+    return problems
+
+def write_grid_file(ds: xr.Dataset):
+    """Write the static (non-time) coordinates of ds to GRID_FILE once."""
+    if os.path.exists(GRID_FILE):
+        return
+
+    grid = ds.coords.to_dataset().drop_dims("time")
+    # Concurrent workers (processes, or threads sharing one PID) may race on
+    # the first run: each writes its own unique temp file; last replace wins
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(GRID_FILE), suffix=".tmp")
+    os.close(fd)
+    try:
+        grid.to_netcdf(tmp_file, engine="h5netcdf")
+        os.replace(tmp_file, GRID_FILE)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+    print_with_timestamp(f"Saved static grid coordinates to {GRID_FILE}")
+
+# Define the "common sense" rules
+QC_RULES = {
+    # Variable: {min: min_val, max: max_val}
+    "T2": {"min": 220, "max": 330},      # Temp: -53°C to 57°C
+    "ACRAINLSM": {"min": -1},           # Precip: Allow for near-zero
+    "Q2": {"min": -1},                  # Humidity: Allow for near-zero
+    "W": {"min": -1},                   # Wind Speed: Allow for near-zero
+    "LAI": {"min": -1},                 # Leaf Area Index: Allow for near-zero
+}
+
+# Internal consistency check: Dewpoint (TD2) cannot be > Temperature (T2)
+TD2_T2_CHECK = True
+# Allowed TD2 - T2 excess: float noise, plus one packing step since both are
+# rounded to the same int16 grid before QC sees them
+TD2_T2_TOLERANCE = 1e-3 + NETCDF_PACKING.get("T2", {}).get("scale_factor", 0.0)
+
+# QC_RULES compiled once into aligned threshold arrays (missing bound = +/-inf)
+QC_VARS = list(QC_RULES)
+QC_MIN = np.array([QC_RULES[v].get("min", -np.inf) for v in QC_VARS])
+QC_MAX = np.array([QC_RULES[v].get("max", np.inf) for v in QC_VARS])
+
 def validate_daily_file(daily_file_path: str) -> bool:
     print_with_timestamp(f"VALIDATION START: {daily_file_path}")
 
-    # Define the "common sense" rules
-    QC_RULES = {
-        # Variable: {min: min_val, max: max_val}
-        "T2": {"min": 220, "max": 330},      # Temp: -53°C to 57°C
-        "ACRAINLSM": {"min": -1},           # Precip: Allow for near-zero
-        "Q2": {"min": -1},                  # Humidity: Allow for near-zero
-        "W": {"min": -1},                   # Wind Speed: Allow for near-zero
-        "LAI": {"min": -1},                 # Leaf Area Index: Allow for near-zero
-    }
-    
-    # Internal consistency check: Dewpoint (TD2) cannot be > Temperature (T2)
-    TD2_T2_CHECK = True
-
     try:
-        with xr.open_dataset(daily_file_path) as ds:
-            for var, rules in QC_RULES.items():
+        # Open lazily (one dask chunk per time step) and submit every QC
+        # statistic in a single dask.compute() so the file is read once
+        with xr.open_dataset(daily_file_path, chunks={"time": 1}, engine="h5netcdf") as ds:
+            present = np.array([v in ds for v in QC_VARS])
+            lazy = []
+            for var in QC_VARS:
                 if var in ds:
-                    data = ds[var].values
-                    
-                    if "min" in rules:
-                        min_val = np.nanmin(data)
-                        if min_val < rules["min"]:
-                            print_with_timestamp(f"  QC FAIL: {var} min value {min_val:.6f} is below threshold {rules['min']}")
-                            return False
-                    
-                    if "max" in rules:
-                        max_val = np.nanmax(data)
-                        if max_val > rules["max"]:
-                            print_with_timestamp(f"  QC FAIL: {var} max value {max_val:.2f} is above threshold {rules['max']}")
-                            return False
-            
-            if TD2_T2_CHECK and "T2" in ds and "TD2" in ds:
-                # Allow for floating point noise (1e-3)
-                if (ds["TD2"] > ds["T2"] + 1e-3).any():
-                    print_with_timestamp(f"  QC FAIL: Internal consistency error. Found TD2 > T2.")
-                    return False
+                    lazy += [ds[var].min(), ds[var].max()]
+
+            check_td2 = TD2_T2_CHECK and "T2" in ds and "TD2" in ds
+            if check_td2:
+                lazy.append((ds["TD2"] > ds["T2"] + TD2_T2_TOLERANCE).any())
+
+            results = dask.compute(*lazy, scheduler="threads")
 
     except Exception as e:
-        print_with_timestamp(f"  QC FAIL: Could not open or read file. Error: {e}")
+        print_with_timestamp(f"  QC FAIL: {daily_file_path}: Could not open or read file. Error: {e}")
+        return False
+
+    n_present = int(present.sum())
+    mins = np.full(len(QC_VARS), np.nan)
+    maxs = np.full(len(QC_VARS), np.nan)
+    mins[present] = [float(r) for r in results[0:2 * n_present:2]]
+    maxs[present] = [float(r) for r in results[1:2 * n_present:2]]
+
+    # NaN (absent or all-missing) compares False, as np.nanmin did before
+    below = mins < QC_MIN
+    above = maxs > QC_MAX
+    for i in np.flatnonzero(below | above):
+        var = QC_VARS[i]
+        if below[i]:
+            print_with_timestamp(f"  QC FAIL: {daily_file_path}: {var} min value {mins[i]:.6f} is below threshold {QC_MIN[i]:g}")
+        else:
+            print_with_timestamp(f"  QC FAIL: {daily_file_path}: {var} max value {maxs[i]:.2f} is above threshold {QC_MAX[i]:g}")
+        return False
+
+    if check_td2 and bool(results[-1]):
+        print_with_timestamp(f"  QC FAIL: {daily_file_path}: Internal consistency error. Found TD2 > T2.")
         return False
     
     print_with_timestamp(f"VALIDATION SUCCESS: {daily_file_path}")
     return True
 
-def run_download_and_validation(date: dt.date) -> (str | None, bool):
+def plan_aggregation(ds: xr.Dataset) -> tuple:
+    """Split the variables present in ds into (intensive, extensive, derived).
+
+    Depends only on the store schema, so callers sharing one dataset across
+    days compute it once and pass it to aggregate_day.
+    """
+    # Plain set lookups instead of Dataset.__contains__ (data_vars + coords)
+    present = set(ds.data_vars)
+    for var in (v for v in VARIABLE_AGG_MAP if v not in present):
+        print_with_timestamp(f"WARNING: Variable {var} not found in dataset, skipping")
+
+    intensive_vars = [v for v, is_intensive in VARIABLE_AGG_MAP.items() if is_intensive and v in present]
+    extensive_vars = [v for v, is_intensive in VARIABLE_AGG_MAP.items() if not is_intensive and v in present]
+    derived_vars = [v for v, info in DERIVED_VARS.items()
+                    if present.issuperset(info["depends_on"])]
+    return intensive_vars, extensive_vars, derived_vars
+
+def aggregate_day(ds: xr.Dataset, date: dt.date, plan: tuple | None = None) -> xr.Dataset | None:
+    """Select one day from ds and load its daily aggregate into memory.
+
+    plan is the result of plan_aggregation(ds); it is computed here if not given.
+    Returns None (after logging why) if the day cannot be aggregated.
+    """
     date_str = date.strftime('%Y-%m-%d')
-    print_with_timestamp(f"DOWNLOAD START: {date_str}")
-    
-    ds = get_signed_conus_dataset()
-    if ds is None:
-        return None, False
 
     try:
         start = pd.Timestamp(date.year, date.month, date.day, 0, 0, 0)
-        end = pd.Timestamp(date.year, date.month, date.day, 23, 59, 59)
-        sel = ds.sel(time=slice(start, end))
-        
-        print_with_timestamp("Manually decoding CF conventions (fill values)...")
-        sel = xr.decode_cf(sel)
+        end = start + pd.Timedelta(days=1)
+        # The decoded time index is already in memory (shared across days in
+        # the in-process driver); slice it by position with a binary search
+        i0, i1 = ds.indexes["time"].searchsorted([start, end])
+        sel = ds.isel(time=slice(i0, i1))
         
     except Exception as e:
         print_with_timestamp(f"ERROR: Failed to select or decode time for {date_str}. Exception: {e}")
-        ds.close()
-        return None, False  
+        return None
     if sel.time.size == 0:
         print_with_timestamp(f"WARNING: No data available for {date_str}")
-        ds.close()
-        return None, False
+        return None
+    
+    print_with_timestamp(f"Found {sel.time.size} hourly records for {date_str}.")
+    day = pd.Timestamp(date.year, date.month, date.day)
+
+    # Aggregate in float32 (CONUS404's native precision) even if CF decoding
+    # promoted a variable to float64; halves the bytes each reduction touches
+    sel = sel.astype(np.float32, copy=False)
     
-    print_with_timestamp(f"Found {sel.time.size} hourly records.")
+    intensive_vars, extensive_vars, derived_vars = plan or plan_aggregation(ds)
+
+    try:
+        # Reduce each group as one Dataset so dask builds a single graph
+        # and co-schedules the chunk reads shared between variables
+        intensive = sel[intensive_vars].mean(dim="time", keep_attrs=True)
+        extensive = sel[extensive_vars].sum(dim="time", keep_attrs=True)
+        agg_ds = xr.merge([intensive, extensive])
+        agg_ds = agg_ds.expand_dims(time=[day])
+    except Exception as e:
+        print_with_timestamp(f"ERROR: Failed during daily aggregation for {date_str}. Exception: {e}")
+        return None
     
     try:
-        agg_vars = {}
-        for var, is_intensive in VARIABLE_AGG_MAP.items():
-            if var not in sel:
-                print_with_timestamp(f"WARNING: Variable {var} not found for {date_str}, skipping")
-                continue
-            
-            da = sel[var]
-            if is_intensive:
-                da_agg = da.mean(dim="time", keep_attrs=True)
+        for new_var in derived_vars:
+            info = DERIVED_VARS[new_var]
+            # Derive from the hourly fields (e.g. mean wind speed rather
+            # than speed of the mean wind). calc_fn runs once per chunk on
+            # plain numpy arrays: one blockwise task instead of a dask layer
+            # per arithmetic op
+            computed = xr.apply_ufunc(
+                info["calc_fn"],
+                *(sel[dep] for dep in info["depends_on"]),
+                dask="parallelized",
+                output_dtypes=[np.float32],
+            )
+            if info["intensive"]:
+                computed = computed.mean(dim="time", keep_attrs=True)
             else:
-                da_agg = da.sum(dim="time", keep_attrs=True)
-            
-            da_agg = da_agg.expand_dims(time=[pd.Timestamp(date.year, date.month, date.day)])
-            agg_vars[var] = da_agg
-        
-        agg_ds = xr.Dataset(agg_vars)
+                computed = computed.sum(dim="time", keep_attrs=True)
+            agg_ds[new_var] = computed.expand_dims(time=[day])
     except Exception as e:
-        print_with_timestamp(f"ERROR: Failed during daily aggregation. Exception: {e}")
-        ds.close()
-        return None, False
+        print_with_timestamp(f"ERROR: Failed during derived var calculation for {date_str}. Exception: {e}")
+        return None
+
+    try:
+        # Pull the (small) daily result into memory while the store is open
+        print_with_timestamp(f"Computing daily aggregate for {date_str}...")
+        return agg_ds.load()
+    except Exception as e:
+        print_with_timestamp(f"ERROR: Failed to compute daily aggregate for {date_str}. Exception: {e}")
+        return None
+
+def run_download_and_validation(date: dt.date, ds: xr.Dataset | None = None,
+                                plan: tuple | None = None) -> (str | None, bool):
+    """Aggregate, save and validate one day.
+
+    If ds is given it is a dataset shared with other days and is left open
+    (plan, if given, is its plan_aggregation result); otherwise a dataset is
+    opened for this day alone and closed as soon as the aggregate is in
+    memory, before the NetCDF write starts. A daily file left by an earlier
+    run that still passes validation is kept and the day is skipped.
+    """
+    date_str = date.strftime('%Y-%m-%d')
+    daily_file = os.path.join(DAILY_DIR, f"conus404_daily_{date.strftime('%Y%m%d')}.nc")
+
+    # Reruns and gap-filling: don't touch the store for days already done,
+    # as long as the file is in the current layout with every variable
+    if os.path.exists(daily_file):
+        print_with_timestamp(f"Found existing {daily_file}; validating before re-download")
+        if plan is not None:
+            expected = {v for group in plan for v in group}
+        else:
+            expected = set(VARIABLE_AGG_MAP) | set(DERIVED_VARS)
+        problems = existing_file_problems(daily_file, expected)
+        for problem in problems:
+            print_with_timestamp(f"  {date_str}: existing file {problem}; re-downloading")
+        if not problems and validate_daily_file(daily_file):
+            print_with_timestamp(f"SKIP: {date_str} already downloaded and valid")
+            return daily_file, True
+
+    print_with_timestamp(f"DOWNLOAD START: {date_str}")
     
+    if ds is None:
+        ds = get_signed_conus_dataset()
+        if ds is None:
+            return None, False
+        store = contextlib.closing(ds)
+    else:
+        store = contextlib.nullcontext(ds)
+
+    # Phase 1: remote read + aggregation
+    with store:
+        agg_ds = aggregate_day(ds, date, plan)
+    if agg_ds is None:
+        return None, False
+
+    # Phase 2: local writes from the in-memory aggregate
     try:
-        if DERIVED_VARS:
-            for new_var, info in DERIVED_VARS.items():
-                deps = info["depends_on"]
-                if all(dep in agg_ds for dep in deps):
-                    computed = info["calc_fn"](*(agg_ds[dep] for dep in deps))
-                    computed = computed.assign_coords(time=agg_ds.time)
-                    agg_ds[new_var] = computed
+        write_grid_file(agg_ds)
     except Exception as e:
-        print_with_timestamp(f"ERROR: Failed during derived var calculation. Exception: {e}")
-        ds.close()
+        print_with_timestamp(f"ERROR: Failed to save grid coordinates for {date_str}. Exception: {e}")
+        return None, False
+
+    # lat/lon live in GRID_FILE; only keep index coords (time) per day
+    agg_ds = agg_ds.reset_coords(drop=True)
+
+    # QC only sees the packed file, so refuse values packing would corrupt
+    problems = find_unpackable(agg_ds)
+    if problems:
+        for problem in problems:
+            print_with_timestamp(f"  QC FAIL: {date_str}: {problem}")
         return None, False
-    
-    # Close source dataset
-    ds.close()
-    del sel
-    
-    daily_dir = os.path.join(DATA_DIR, "unprocessed", "daily")
-    os.makedirs(daily_dir, exist_ok=True)
-    daily_file = os.path.join(daily_dir, f"conus404_daily_{date.strftime('%Y%m%d')}.nc")
     
     try:
         print_with_timestamp(f"Saving daily aggregate to {daily_file}")
-        agg_ds.compute().to_netcdf(daily_file)
+        agg_ds.to_netcdf(daily_file, engine="h5netcdf", encoding=build_daily_encoding(agg_ds))
         print_with_timestamp(f"DOWNLOAD COMPLETE: {date_str}")
     except Exception as e:
-        print_with_timestamp(f"ERROR: Failed to save final NetCDF file. Exception: {e}")
+        print_with_timestamp(f"ERROR: Failed to save final NetCDF file {daily_file}. Exception: {e}")
         return None, False
     
     validation_passed = validate_daily_file(daily_file)
@@ -180,6 +455,41 @@ def run_download_and_validation(date: dt.date) -> (str | None, bool):
     return daily_file, validation_passed
 
 
+def process_day(date: dt.date, ds: xr.Dataset | None = None,
+                plan: tuple | None = None) -> bool:
+    """Run one day end to end and remove its file if validation fails.
+
+    Returns True only if the daily file was created and validated.
+    """
+    daily_file = None
+    validation_passed = False
+
+    try:
+        daily_file, validation_passed = run_download_and_validation(date=date, ds=ds, plan=plan)
+
+    except Exception as e:
+        print_with_timestamp(f"FATAL: An unhandled exception occurred. Exception: {e}")
+        import traceback
+        traceback.print_exc()
+
+    if daily_file and validation_passed:
+        print_with_timestamp(f"SUCCESS: {daily_file} created and validated.")
+        return True
+
+    elif daily_file and not validation_passed:
+        print_with_timestamp(f"FAILED: File {daily_file} was created but FAILED validation.")
+        try:
+            os.remove(daily_file)
+            print_with_timestamp(f"Cleaned up corrupt file: {daily_file}")
+        except Exception as e:
+            print_with_timestamp(f"ERROR: Could not clean up corrupt file {daily_file}. Error: {e}")
+        return False
+
+    else:
+        print_with_timestamp(f"FAILED: Download unsuccessful for {date}, no file created.")
+        return False
+
+
 if __name__ == "__main__":
     if len(sys.argv) != 2:
         print("Usage: python single_download.py <date_str>")
@@ -194,36 +504,7 @@ if __name__ == "__main__":
         sys.exit(1)
         
     print_with_timestamp(f"Starting process for {date_str} (PID: {os.getpid()})")
-    
-    daily_file = None
-    validation_passed = False
-    
-    try:
-        # Run the main function
-        daily_file, validation_passed = run_download_and_validation(date=date)
-        
-    except Exception as e:
-        print_with_timestamp(f"FATAL: An unhandled exception occurred. Exception: {e}")
-        import traceback
-        traceback.print_exc()
-        
-    finally:
-        # Exit with the correct code
-        if daily_file and validation_passed:
-            print_with_timestamp(f"SUCCESS: {daily_file} created and validated.")
-            sys.exit(0)
-            
-        elif daily_file and not validation_passed:
-            print_with_timestamp(f"FAILED: File {daily_file} was created but FAILED validation.")
-            try:
-                os.remove(daily_file)
-                print_with_timestamp(f"Cleaned up corrupt file: {daily_file}")
-            except Exception as e:
-                print_with_timestamp(f"ERROR: Could not clean up corrupt file. Error: {e}")
-            sys.exit(1)
-            
-        else:
-            print_with_timestamp("FAILED: Download unsuccessful, no file created.")
-            sys.exit(1)
-
+    os.makedirs(DAILY_DIR, exist_ok=True)
 
+    # Exit with the correct code
+    sys.exit(0 if process_day(date) else 1)
@@ -1,11 +1,67 @@
+import os
 import xarray as xr
+from dask.diagnostics import ProgressBar
 from pathlib import Path
 
 INPUT_DIR = Path(".")          # directory containing .nc files
 OUTPUT_FILE = Path("combined.nc") # output filename
+GRID_FILE = "conus404_grid.nc"    # static lat/lon written once by the pipeline
+DAILY_PREFIX = "conus404_daily_"  # daily files are conus404_daily_YYYYMMDD.nc
+PACKING_ATTRS = ("scale_factor", "add_offset", "_FillValue")
+
+class PackingMismatch(ValueError):
+    """Daily files do not all store a variable with the same packing."""
+
+def packing_signature(ds):
+    """Per-variable (dtype, scale_factor, add_offset, _FillValue) of an undecoded dataset."""
+    return {var: (str(ds[var].dtype),) + tuple(repr(ds[var].attrs.get(k)) for k in PACKING_ATTRS)
+            for var in ds.data_vars}
+
+def open_daily_files(files, decoded):
+    """Open the daily files as one lazy dataset concatenated along time.
+
+    Undecoded (decoded=False) keeps the packed int16 values so they are
+    copied rather than unpacked and repacked; every file must then share
+    the first file's packing, or PackingMismatch is raised.
+    """
+    preprocess = None
+    if not decoded:
+        with xr.open_dataset(files[0], engine="h5netcdf", mask_and_scale=False) as first:
+            reference = packing_signature(first)
+
+        def preprocess(day):
+            if packing_signature(day) != reference:
+                raise PackingMismatch(f"{day.encoding.get('source', 'a daily file')} is packed "
+                                      f"differently from {files[0].name}")
+            return day
+
+    # One dask chunk per day; only variables with a time dim are
+    # concatenated and coords/attrs are taken from the first file.
+    # Filenames sort by date, so concatenate in that order rather than
+    # comparing every file's time index
+    return xr.open_mfdataset(
+        files,
+        combine="nested",
+        concat_dim="time",
+        parallel=True,
+        engine="h5netcdf",
+        chunks={"time": 1},
+        mask_and_scale=decoded,
+        preprocess=preprocess,
+        data_vars="minimal",
+        coords="minimal",
+        compat="override",
+        combine_attrs="override"
+    )
 
 def combine_nc_files(input_dir, output_file):
-    files = sorted(input_dir.glob("*.nc"))
+    # One directory read with no pattern translation; the prefix also keeps
+    # GRID_FILE out. Order by the YYYYMMDD slug; the nested concat below
+    # relies on this being date order
+    with os.scandir(input_dir) as entries:
+        files = [Path(e.path) for e in entries
+                 if e.name.startswith(DAILY_PREFIX) and e.name.endswith(".nc")]
+    files.sort(key=lambda f: f.name[-11:-3])
     if not files:
         print("No .nc files found.")
         return
@@ -15,13 +71,37 @@ def combine_nc_files(input_dir, output_file):
         print(f"  {f.name}")
 
     try:
-        ds = xr.open_mfdataset(
-            files,
-            combine="by_coords",
-            parallel=True,
-            engine="h5netcdf"
-        )
-        ds.to_netcdf(output_file)
+        try:
+            ds = open_daily_files(files, decoded=False)
+            decoded = False
+        except PackingMismatch as e:
+            # Mixed formats (e.g. older float32 files, or NETCDF_PACKING was
+            # changed): decode every file with its own scale and write float32
+            print(f"WARNING: {e}; combining decoded values as float32 instead")
+            ds = open_daily_files(files, decoded=True)
+            decoded = True
+
+        # Daily files no longer carry the spatial coordinates; restore them
+        grid_path = input_dir / GRID_FILE
+        if grid_path.exists():
+            grid = xr.open_dataset(grid_path, engine="h5netcdf")
+            ds = xr.merge([ds, grid.set_coords(list(grid.data_vars))])
+
+        encoding = {}
+        for var in ds.data_vars:
+            encoding[var] = {"zlib": True, "complevel": 1, "shuffle": True}
+            if decoded:
+                # Don't re-apply the first file's packing to the mixed values
+                ds[var].encoding = {}
+                encoding[var]["dtype"] = "float32"
+            if ds[var].dims[:1] == ("time",) and ds[var].ndim >= 3:
+                # One chunk per day and level, matching the daily files
+                encoding[var]["chunksizes"] = (1,) * (ds[var].ndim - 2) + ds[var].shape[-2:]
+
+        # Stream day-sized chunks to disk instead of materializing each variable
+        delayed = ds.to_netcdf(output_file, engine="h5netcdf", compute=False, encoding=encoding)
+        with ProgressBar():
+            delayed.compute(scheduler="threads")
         ds.close()
         print(f"Combined file saved as: {output_file}")
     except Exception as e: